@@ -1,12 +1,27 @@
+import io
 import os
+import re
+import queue
+import time
+import uuid
+import atexit
 import sqlite3
 import base64
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import date
-from flask import Flask, request, jsonify, send_from_directory
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, init just runs unserialized
+    fcntl = None
+from cachetools import TTLCache
+from flask import Flask, Response, g, request, jsonify, make_response, render_template
+from flask.json.provider import JSONProvider
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-import google.generativeai as genai
-from openai import OpenAI
+import orjson
 
 # ---------------- CONFIG ----------------
 load_dotenv()
@@ -14,111 +29,648 @@ load_dotenv()
 PORT = int(os.getenv("PORT", 5000))
 GEMINI_KEY = os.getenv("GEMINI_API_KEY")
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
-
-genai.configure(api_key=GEMINI_KEY)
-openai_client = OpenAI(api_key=OPENAI_KEY)
+GEMINI_MODEL = "gemini-2.5-flash-lite"
+VISION_MODEL = "gpt-4o"
+# generation time grows with every token produced, so keep replies short
+CHAT_MAX_TOKENS = 256
+SUMMARY_MAX_TOKENS = 512
+VISION_MAX_TOKENS = 250
+TEMPERATURE = 0.4
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", 32))
+# seconds before an upstream LLM call is abandoned; a stalled call would otherwise
+# hold its pool slot (and every request waiting on the same prompt) indefinitely
+LLM_TIMEOUT = 30
+LLM_CACHE_TTL = 3600
+PROMPT_VERSION = 1  # bump whenever SAFETY_PREFIX changes so cached replies are dropped
 
 DB_PATH = "medibot.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
 UPLOAD_FOLDER = "uploads"
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", 32))
+# "low" is a fixed ~85-token budget at 512px; set VISION_DETAIL=high for fine detail
+VISION_DETAIL = os.getenv("VISION_DETAIL", "low")
+IMAGE_MAX_SIDE = 512 if VISION_DETAIL == "low" else 768
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", 86400))
+JOB_TTL = 600
+JOB_TIMEOUT = 180  # an unfinished job older than this was lost (worker restart etc.)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = STATIC_MAX_AGE
+# behind apache mod_xsendfile or lighttpd (not nginx), let the server stream files instead of Python
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE") == "1"
+
+class ORJSONProvider(JSONProvider):
+    # orjson is several times faster than the stdlib encoder on the reminder lists
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify() path: hand orjson's bytes straight to the response, no str round-trip.
+        # _prepare_response_obj is private Flask API; recheck it when bumping the Flask==2.2.5 pin
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+app.json = ORJSONProvider(app)
 
 # ---------------- HELPERS ----------------
 def today():
     return date.today().isoformat()
 
 def get_user_id():
-    return request.remote_addr  # simple per-user partition
+    # simple per-user partition; resolved once per request and kept on g, which is
+    # also the one place to swap in an authenticated id later
+    uid = g.get("_uid")
+    if uid is None:
+        uid = g._uid = request.remote_addr or "anon"
+    return uid
+
+# ---------------- SQL ----------------
+# All statements live here as module constants, so the SQL is in one place.
+SQL_INSERT_REMINDER = "INSERT INTO reminders (name, time, completed, user_id) VALUES (?, ?, 0, ?)"
+SQL_LIST_REMINDERS = "SELECT id, name, time, completed FROM reminders WHERE user_id=? ORDER BY time"
+SQL_COMPLETE_REMINDER = "UPDATE reminders SET completed=1 WHERE id=? AND user_id=?"
+SQL_DELETE_COMPLETED = "DELETE FROM reminders WHERE completed=1 AND user_id=?"
+SQL_PENDING_REMINDERS = "SELECT name, time FROM reminders WHERE user_id=? AND completed=0 ORDER BY time"
+SQL_GET_WATER = "SELECT count FROM water WHERE date=? AND user_id=?"
+SQL_INSERT_JOB = "INSERT INTO jobs (id, user_id, created) VALUES (?, ?, ?)"
+SQL_FINISH_JOB = "UPDATE jobs SET result=? WHERE id=?"
+SQL_GET_JOB = "SELECT result, created FROM jobs WHERE id=? AND user_id=?"
+SQL_PRUNE_JOBS = "DELETE FROM jobs WHERE created < ?"
+SQL_GET_LLM_CACHE = "SELECT response FROM llm_cache WHERE key=? AND ts>?"
+SQL_PUT_LLM_CACHE = "INSERT OR REPLACE INTO llm_cache (key, ts, model, response) VALUES (?, ?, ?, ?)"
+SQL_PRUNE_LLM_CACHE = "DELETE FROM llm_cache WHERE ts<=?"
+SQL_ADD_WATER = """
+    INSERT INTO water (date, count, user_id)
+    VALUES (?, 1, ?)
+    ON CONFLICT(date, user_id)
+    DO UPDATE SET count = count + 1
+    RETURNING count
+"""
 
 # ---------------- DATABASE ----------------
+_DB_POOL = queue.Queue()
+_DB_CONNS = []
+_DB_LOCK = threading.Lock()
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+def _checkout():
+    try:
+        return _DB_POOL.get_nowait()
+    except queue.Empty:
+        pass
+    with _DB_LOCK:
+        if len(_DB_CONNS) < DB_POOL_SIZE:
+            conn = _connect()
+            _DB_CONNS.append(conn)
+            return conn
+    return _DB_POOL.get()
+
+@contextmanager
+def _get_conn():
+    # long-lived pooled connections keep SQLite's page cache warm across requests
+    conn = _checkout()
+    try:
+        with conn:
+            yield conn
+    finally:
+        _DB_POOL.put(conn)
+
+_INHERITED_CONNS = []
+
+def _reset_pool_after_fork():
+    # SQLite handles must not cross fork(); children start with an empty pool.
+    # The parent's handles are kept referenced (never closed) so their locks are untouched.
+    global _DB_POOL, _DB_CONNS, _DB_LOCK
+    _INHERITED_CONNS.extend(_DB_CONNS)
+    _DB_POOL = queue.Queue()
+    _DB_CONNS = []
+    _DB_LOCK = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+@atexit.register
+def _close_all():
+    with _DB_LOCK:
+        for conn in _DB_CONNS:
+            conn.close()
+        _DB_CONNS.clear()
+
+# ---------------- WRITE BATCHING ----------------
+# Reminder inserts go through one writer thread that commits whatever has queued
+# up meanwhile in a single transaction, so bursts share one fsync instead of one each.
+WRITE_BATCH_MAX = 64
+_WRITE_QUEUE = queue.Queue()
+_WRITER_LOCK = threading.Lock()
+_writer = None
+
+def _reminder_writer():
+    while True:
+        batch = [_WRITE_QUEUE.get()]
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(_WRITE_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            with _get_conn() as conn:
+                conn.executemany(SQL_INSERT_REMINDER, [row for row, _ in batch])
+        except Exception:
+            # one bad row shouldn't fail its neighbours; retry them one at a time
+            for row, fut in batch:
+                try:
+                    with _get_conn() as conn:
+                        conn.execute(SQL_INSERT_REMINDER, row)
+                except Exception as e:
+                    fut.set_exception(e)
+                else:
+                    fut.set_result(True)
+        else:
+            for _, fut in batch:
+                fut.set_result(True)
+
+def queue_reminder(row):
+    global _writer
+    with _WRITER_LOCK:
+        # also restarts the writer in a forked worker, where the parent's thread is gone
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_reminder_writer, daemon=True)
+            _writer.start()
+    fut = Future()
+    _WRITE_QUEUE.put((row, fut))
+    return fut
+
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
+    # every gunicorn worker imports the app; the lock lets one set up the
+    # schema while the rest wait instead of fighting over the write lock
+    with open(DB_PATH + ".lock", "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        _create_schema()
+
+def _create_schema():
+    # one script in one transaction: a single commit for the whole schema
+    with _get_conn() as conn:
+        conn.executescript("""
+        BEGIN;
 
-        c.execute("""
         CREATE TABLE IF NOT EXISTS reminders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT,
             time TEXT,
             completed INTEGER DEFAULT 0,
             user_id TEXT
-        )
-        """)
+        );
+
+        -- serves the per-user list ordered by time without a sort step
+        CREATE INDEX IF NOT EXISTS idx_reminders_user_time ON reminders(user_id, time);
+        -- covers the pending-reminder read (no table lookups) and the completed cleanup
+        CREATE INDEX IF NOT EXISTS idx_reminders_user_completed ON reminders(user_id, completed, time, name);
 
-        c.execute("""
         CREATE TABLE IF NOT EXISTS water (
             date TEXT,
             count INTEGER,
             user_id TEXT,
             PRIMARY KEY (date, user_id)
-        )
-        """)
+        );
 
-        conn.commit()
+        -- job state lives in the db so any gunicorn worker can answer a poll
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            result TEXT,
+            created REAL
+        );
+
+        -- second-level prompt cache; unlike the in-memory one it survives restarts
+        -- and is shared by all workers
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            ts INTEGER,
+            model TEXT,
+            response TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_llm_cache_ts ON llm_cache(ts);
+
+        COMMIT;
+        """)
 
 # ---------------- AI ----------------
-def safety_prefix():
-    return (
-        "You are Medibot, an educational medical assistant.\n"
-        "Do NOT diagnose.\n"
-        "Do NOT prescribe.\n"
-        "Educational guidance only.\n\n"
-    )
-
-def generate_text(prompt):
+SAFETY_PREFIX = (
+    "You are Medibot, an educational medical assistant.\n"
+    "Do NOT diagnose.\n"
+    "Do NOT prescribe.\n"
+    "Educational guidance only.\n\n"
+)
+
+# The SDKs and Pillow are imported on first use so workers boot fast and
+# routes like /api/water never pay for them.
+_genai = None
+_gemini_model = None
+_openai_client = None
+_AI_LOCK = threading.Lock()
+
+# Each getter checks without the lock first: after the first call the
+# objects never change, so the hot path is a plain global read.
+def get_genai():
+    global _genai
+    if _genai is None:
+        with _AI_LOCK:
+            if _genai is None:
+                import google.generativeai as genai
+                # REST goes through requests, which gevent's monkey-patching makes
+                # cooperative; the default gRPC core would block the worker's whole hub
+                genai.configure(api_key=GEMINI_KEY, transport="rest")
+                _genai = genai
+    return _genai
+
+def get_gemini_model():
+    global _gemini_model
+    if _gemini_model is None:
+        genai = get_genai()
+        with _AI_LOCK:
+            if _gemini_model is None:
+                # the safety rules go in as a system instruction rather than being glued onto every prompt
+                _gemini_model = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SAFETY_PREFIX)
+    return _gemini_model
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        with _AI_LOCK:
+            if _openai_client is None:
+                import httpx
+                from openai import OpenAI
+                # one keep-alive pool so uploads skip the TCP/TLS handshake to OpenAI
+                shared_http = httpx.Client(
+                    http2=True,
+                    timeout=LLM_TIMEOUT,
+                    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+                )
+                _openai_client = OpenAI(api_key=OPENAI_KEY, http_client=shared_http)
+    return _openai_client
+
+# repeated chats and summary refreshes reuse the last answer instead of calling Gemini again
+_TEXT_CACHE = TTLCache(maxsize=2048, ttl=LLM_CACHE_TTL)
+_TEXT_CACHE_LOCK = threading.Lock()
+# re-uploads of the same picture are answered without another vision call
+_IMAGE_CACHE = TTLCache(maxsize=256, ttl=LLM_CACHE_TTL)
+_IMAGE_CACHE_LOCK = threading.Lock()
+_WS = re.compile(r"\s+")
+# identical prompts arriving together share one upstream call; every Gemini call
+# runs on _LLM_POOL, so its size caps how many we have open at once (keeps us
+# clear of 429s) and extra ones queue there. Under gevent's monkey-patching the
+# pool's workers are greenlets, so it is a cap, not isolation: calls only yield
+# to other requests because the SDK is on the REST transport (see get_genai)
+_INFLIGHT = {}
+_LLM_POOL = ThreadPoolExecutor(max_workers=GEMINI_CONCURRENCY, thread_name_prefix="llm")
+
+def prompt_key(model, prompt, max_tokens):
+    # case and whitespace differences ("Fever  rash" vs "fever rash\n") shouldn't miss the cache
+    norm = _WS.sub(" ", prompt.lower()).strip()
+    return hashlib.sha256(f"{model}:{max_tokens}:{PROMPT_VERSION}:{norm}".encode()).hexdigest()
+
+def generation_config(max_tokens):
+    return {"max_output_tokens": max_tokens, "temperature": TEMPERATURE}
+
+REQUEST_OPTIONS = {"timeout": LLM_TIMEOUT}
+
+AI_ERROR = "AI error. Try again."
+
+def _claim(key):
+    # -> (cached reply, in-flight Future); when both are None the caller owns the call
+    with _TEXT_CACHE_LOCK:
+        hit = _TEXT_CACHE.get(key)
+        if hit is not None:
+            return hit, None
+        pending = _INFLIGHT.get(key)
+        if pending is None:
+            _INFLIGHT[key] = Future()
+        return None, pending
+
+def _settle(key, text):
+    with _TEXT_CACHE_LOCK:
+        if text is not None:
+            _TEXT_CACHE[key] = text
+        done = _INFLIGHT.pop(key)
+    reply = text if text is not None else AI_ERROR
+    done.set_result(reply)
+    return reply
+
+# The llm_cache table backs the in-memory cache. It is best effort: a
+# database error just means a miss (or an unsaved reply), never a failed request.
+def cache_load(key):
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash-lite")
-        r = model.generate_content(safety_prefix() + prompt)
-        return r.text.strip()
+        with _get_conn() as conn:
+            row = conn.execute(SQL_GET_LLM_CACHE, (key, int(time.time()) - LLM_CACHE_TTL)).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+def cache_store(key, text):
+    now = int(time.time())
+    try:
+        with _get_conn() as conn:
+            conn.execute(SQL_PRUNE_LLM_CACHE, (now - LLM_CACHE_TTL,))
+            conn.execute(SQL_PUT_LLM_CACHE, (key, now, GEMINI_MODEL, text))
+    except sqlite3.Error:
+        pass
+
+def ask_gemini(prompt, max_tokens):
+    try:
+        r = get_gemini_model().generate_content(
+            prompt, generation_config=generation_config(max_tokens), request_options=REQUEST_OPTIONS)
+        return r.text.strip() or None  # an empty reply is a failure, not something to cache
     except:
-        return "AI error. Try again."
+        return None
+
+def _pump_stream(key, prompt, max_tokens, out):
+    # Runs on _LLM_POOL and owns the reply: it caches and settles the key itself,
+    # so a client disconnecting mid-stream doesn't cost the waiters their answer.
+    # Chunks go to the request through `out`; the last item is None on success
+    # or the exception that ended the stream.
+    parts = []
+    text = error = None
+    try:
+        stream = get_gemini_model().generate_content(
+            prompt, stream=True, generation_config=generation_config(max_tokens),
+            request_options=REQUEST_OPTIONS)
+        for chunk in stream:
+            parts.append(chunk.text)
+            out.put(chunk.text)
+        text = "".join(parts).strip() or None
+        if text is None:
+            raise ValueError("empty reply from Gemini")
+        cache_store(key, text)
+    except Exception as e:
+        error = e
+    finally:
+        _settle(key, text)
+        out.put(error)
+
+def generate_text(prompt, max_tokens=CHAT_MAX_TOKENS):
+    key = prompt_key(GEMINI_MODEL, prompt, max_tokens)
+    hit, pending = _claim(key)
+    if hit is not None:
+        return hit
+    if pending is not None:
+        return pending.result()
+
+    text = None
+    try:
+        text = cache_load(key)
+        if text is None:
+            text = _LLM_POOL.submit(ask_gemini, prompt, max_tokens).result()
+            if text is not None:
+                cache_store(key, text)
+    finally:
+        # runs even if the lookup or submit raises, so the key never stays claimed
+        reply = _settle(key, text)
+    return reply
+
+def stream_text(prompt, max_tokens=CHAT_MAX_TOKENS):
+    # Same cache and in-flight sharing as generate_text, but yields Gemini's
+    # chunks as they arrive so the first words show up long before the last.
+    key = prompt_key(GEMINI_MODEL, prompt, max_tokens)
+    hit, pending = _claim(key)
+    if hit is not None:
+        yield hit
+        return
+    if pending is not None:
+        yield pending.result()
+        return
+
+    chunks = queue.Queue()
+    try:
+        text = cache_load(key)
+        if text is None:
+            _LLM_POOL.submit(_pump_stream, key, prompt, max_tokens, chunks)
+    except Exception:
+        # nothing will settle the key now, so release it before giving up
+        _settle(key, None)
+        raise
+    if text is not None:
+        _settle(key, text)
+        yield text
+        return
+
+    # only forward from here on; failures (upstream errors, empty replies) propagate
+    # to sse_response, which ends the stream with an error event, not a silent cut-off
+    while True:
+        item = chunks.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def wants_stream():
+    return request.accept_mimetypes.best_match(["application/json", "text/event-stream"]) == "text/event-stream"
+
+def sse_response(chunks):
+    def events():
+        try:
+            for delta in chunks:
+                yield b"data: " + orjson.dumps({"delta": delta}) + b"\n\n"
+        except Exception:
+            yield b"event: error\ndata: " + orjson.dumps({"error": AI_ERROR}) + b"\n\n"
+    # X-Accel-Buffering stops nginx from holding the stream back
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# formats shrink_image can turn into something the vision model accepts
+IMAGE_MAGIC = (
+    b"\x89PNG\r\n\x1a\n",        # PNG
+    b"\xff\xd8\xff",              # JPEG
+    b"GIF87a", b"GIF89a",         # GIF
+    b"BM",                        # BMP
+    b"II*\x00", b"MM\x00*",       # TIFF
+)
+
+def is_supported_image(head):
+    return head.startswith(IMAGE_MAGIC) or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+
+def shrink_image(data):
+    from PIL import Image, ImageOps
+
+    # phone photos are several megapixels; the model doesn't need them at full size
+    img = Image.open(io.BytesIO(data))
+    # already-compressed small images go as-is; PNG/BMP/TIFF etc. are re-encoded,
+    # since they can be large even at low resolution (and BMP/TIFF aren't accepted)
+    if max(img.size) <= IMAGE_MAX_SIDE and img.format in ("JPEG", "WEBP"):
+        return data, Image.MIME[img.format]
+    # thumbnail first so JPEGs decode in draft mode at reduced size; the re-encode
+    # drops EXIF, so then apply its rotation or portrait photos arrive sideways
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    img = ImageOps.exif_transpose(img)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=85)
+    return buf.getvalue(), "image/jpeg"
+
+# the parts of the vision request that never change are built once at import
+IMAGE_PROMPT_PART = {"type": "text", "text": f"{SAFETY_PREFIX}Explain this image medically (educational)."}
+_IMAGE_KEY_PREFIX = f"{VISION_MODEL}:{VISION_DETAIL}:{PROMPT_VERSION}:".encode()
+
+def analyze_image(data):
+    h = hashlib.sha256(_IMAGE_KEY_PREFIX)
+    h.update(data)
+    key = h.hexdigest()
+    with _IMAGE_CACHE_LOCK:
+        hit = _IMAGE_CACHE.get(key)
+    if hit is not None:
+        return hit
 
-def analyze_image(path):
     try:
-        with open(path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
+        data, mime = shrink_image(data)
+        b64 = base64.b64encode(data).decode()
 
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
+        response = get_openai_client().chat.completions.create(
+            model=VISION_MODEL,
             messages=[{
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": safety_prefix() + "Explain this image medically (educational)."},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}}
+                    IMAGE_PROMPT_PART,
+                    {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}", "detail": VISION_DETAIL}}
                 ]
             }],
-            max_tokens=300
+            max_tokens=VISION_MAX_TOKENS
         )
-        return response.choices[0].message.content.strip()
+        text = response.choices[0].message.content.strip()
     except:
         return ("Image analysis is temporarily unavailable due to service limits.\n"
                 "Please try again later or consult a healthcare professional.\n\n"
                 "Note: This does NOT affect chat-based assistance."
                 )
 
+    with _IMAGE_CACHE_LOCK:
+        _IMAGE_CACHE[key] = text
+    return text
+
+# ---------------- JOBS ----------------
+# vision calls take seconds; run them off the request so uploads return right away
+JOB_POOL = ThreadPoolExecutor(max_workers=4)
+
+def save_upload(path, data):
+    with open(path, "wb") as out:
+        out.write(data)
+
+def _log_save_failure(fut):
+    # nobody waits on the persist write, so its errors would otherwise vanish
+    e = fut.exception()
+    if e is not None:
+        app.logger.error("saving upload failed", exc_info=e)
+
+JOB_FAILED = "Image analysis failed. Please try again."
+
+def run_image_job(jid, data):
+    # always finish the row, or the client would poll it forever
+    try:
+        result = analyze_image(data)
+    except Exception:
+        result = JOB_FAILED
+    with _get_conn() as conn:
+        conn.execute(SQL_FINISH_JOB, (result, jid))
+
 # ---------------- ROUTES ----------------
+def asset_version(*names):
+    # content hash for the asset URLs: a deploy changes the URL, so clients never
+    # run a day-old cached app.js against the new API
+    h = hashlib.sha256()
+    for name in names:
+        with open(os.path.join(app.static_folder, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+ASSET_VERSION = asset_version("app.js", "style.css")
+
 @app.route("/")
 def index():
-    return send_from_directory("templates", "index.html")
+    # the page itself always revalidates (cheap 304 via ETag) so asset changes show up
+    resp = make_response(render_template("index.html", asset_version=ASSET_VERSION))
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 0
+    resp.add_etag()
+    return resp.make_conditional(request)
 
 @app.route("/api/chat", methods=["POST"])
 def chat():
     msg = request.json.get("message", "")
+    if wants_stream():
+        return sse_response(stream_text(msg))
     return jsonify({"reply": generate_text(msg)})
 
 @app.route("/api/summarize", methods=["POST"])
 def summarize():
     text = request.json.get("text", "")
-    return jsonify({"summary": generate_text("Summarize:\n" + text)})
+    prompt = "Summarize:\n" + text
+    if wants_stream():
+        return sse_response(stream_text(prompt, SUMMARY_MAX_TOKENS))
+    return jsonify({"summary": generate_text(prompt, SUMMARY_MAX_TOKENS)})
 
 @app.route("/api/upload_image", methods=["POST"])
 def upload_image():
+    user = get_user_id()
     f = request.files.get("image")
-    path = os.path.join(UPLOAD_FOLDER, secure_filename(f.filename))
-    f.save(path)
-    return jsonify({"medical_assistance": analyze_image(path)})
+    if f is None:
+        return jsonify({"error": "No image uploaded."}), 400
+    # sniff the header so junk is rejected before it is read, decoded or queued
+    head = f.stream.read(32)
+    f.stream.seek(0)
+    if not is_supported_image(head):
+        return jsonify({"error": "Unsupported file. Please upload a PNG, JPEG, WEBP, GIF, BMP or TIFF image."}), 400
+
+    data = f.read()
+
+    jid = uuid.uuid4().hex
+    now = time.time()
+    with _get_conn() as conn:
+        conn.execute(SQL_PRUNE_JOBS, (now - JOB_TTL,))
+        conn.execute(SQL_INSERT_JOB, (jid, user, now))
+    JOB_POOL.submit(run_image_job, jid, data)
+
+    # analysis runs from memory and is already in flight; only keep a copy on disk
+    # when asked to, and write it in the background so the response isn't held up
+    if request.args.get("persist") == "1":
+        # named after the job so uploads never collide or overwrite each other
+        ext = os.path.splitext(secure_filename(f.filename or ""))[1].lower()
+        path = os.path.join(UPLOAD_FOLDER, jid + ext)
+        JOB_POOL.submit(save_upload, path, data).add_done_callback(_log_save_failure)
+    return jsonify({"job": jid})
+
+@app.errorhandler(413)
+def too_large(e):
+    # MAX_CONTENT_LENGTH trips before the view runs; answer in JSON like the other upload errors
+    return jsonify({"error": f"Image too large. The limit is {MAX_UPLOAD_MB} MB."}), 413
+
+@app.route("/api/job/<jid>", methods=["GET"])
+def get_job(jid):
+    user = get_user_id()
+    with _get_conn() as conn:
+        row = conn.execute(SQL_GET_JOB, (jid, user)).fetchone()
+
+    if row is None:
+        return jsonify({"error": "unknown job"}), 404
+    result, created = row
+    if result is None and created < time.time() - JOB_TIMEOUT:
+        # the worker running it went away (or couldn't record the result)
+        result = JOB_FAILED
+    return jsonify({"done": result is not None, "result": result})
 
 # ---------------- REMINDERS ----------------
 @app.route("/api/reminder", methods=["POST"])
@@ -127,51 +679,36 @@ def add_reminder():
     name = request.json["name"]
     time = request.json["time"]
 
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "INSERT INTO reminders (name, time, completed, user_id) VALUES (?, ?, 0, ?)",
-            (name, time, user)
-        )
-        conn.commit()
-
+    # wait for the batched commit so the list the client reloads next includes it
+    queue_reminder((name, time, user)).result()
     return jsonify({"ok": True})
 
+def _reminder_row(cursor, r):
+    # set on the list cursor only; the other queries still unpack tuples
+    return {"id": r[0], "name": r[1], "time": r[2], "completed": bool(r[3])}
+
 @app.route("/api/reminders", methods=["GET"])
 def get_reminders():
     user = get_user_id()
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute(
-            "SELECT id, name, time, completed FROM reminders WHERE user_id=? ORDER BY time",
-            (user,)
-        ).fetchall()
-
-    return jsonify({
-        "reminders": [
-            {"id": r[0], "name": r[1], "time": r[2], "completed": bool(r[3])}
-            for r in rows
-        ]
-    })
+    with _get_conn() as conn:
+        cur = conn.execute(SQL_LIST_REMINDERS, (user,))
+        cur.row_factory = _reminder_row
+        reminders = cur.fetchall()
+
+    return jsonify({"reminders": reminders})
 
 @app.route("/api/reminder/<int:rid>/complete", methods=["POST"])
 def complete_reminder(rid):
     user = get_user_id()
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "UPDATE reminders SET completed=1 WHERE id=? AND user_id=?",
-            (rid, user)
-        )
-        conn.commit()
+    with _get_conn() as conn:
+        conn.execute(SQL_COMPLETE_REMINDER, (rid, user))
     return jsonify({"ok": True})
 
 @app.route("/api/reminders/completed", methods=["DELETE"])
 def delete_completed():
     user = get_user_id()
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "DELETE FROM reminders WHERE completed=1 AND user_id=?",
-            (user,)
-        )
-        conn.commit()
+    with _get_conn() as conn:
+        conn.execute(SQL_DELETE_COMPLETED, (user,))
     return jsonify({"ok": True})
 
 # ---------------- WATER ----------------
@@ -179,11 +716,8 @@ def delete_completed():
 def get_water():
     user = get_user_id()
     d = today()
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT count FROM water WHERE date=? AND user_id=?",
-            (d, user)
-        ).fetchone()
+    with _get_conn() as conn:
+        row = conn.execute(SQL_GET_WATER, (d, user)).fetchone()
 
     return jsonify({"count": row[0] if row else 0})
 
@@ -191,19 +725,8 @@ def get_water():
 def add_water():
     user = get_user_id()
     d = today()
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("""
-            INSERT INTO water (date, count, user_id)
-            VALUES (?, 1, ?)
-            ON CONFLICT(date, user_id)
-            DO UPDATE SET count = count + 1
-        """, (d, user))
-        conn.commit()
-
-        row = conn.execute(
-            "SELECT count FROM water WHERE date=? AND user_id=?",
-            (d, user)
-        ).fetchone()
+    with _get_conn() as conn:
+        row = conn.execute(SQL_ADD_WATER, (d, user)).fetchone()
 
     return jsonify({"count": row[0]})
 
@@ -211,17 +734,20 @@ def add_water():
 @app.route("/api/daily_summary", methods=["GET"])
 def daily_summary():
     user = get_user_id()
-    with sqlite3.connect(DB_PATH) as conn:
-        reminders = conn.execute(
-            "SELECT name, time FROM reminders WHERE user_id=? AND completed=0",
-            (user,)
-        ).fetchall()
+    with _get_conn() as conn:
+        reminders = conn.execute(SQL_PENDING_REMINDERS, (user,)).fetchall()
 
+    # the prompt carries everything the summary depends on (date included), so
+    # generate_text's cache answers refreshes until the reminders change
     reminder_text = "\n".join(f"- {t}: {n}" for n, t in reminders) or "No reminders today."
-    summary = generate_text("Create a daily health summary:\n" + reminder_text)
-    return jsonify({"summary": summary})
+    prompt = f"Create a daily health summary for {today()}:\n" + reminder_text
+    if wants_stream():
+        return sse_response(stream_text(prompt, SUMMARY_MAX_TOKENS))
+    return jsonify({"summary": generate_text(prompt, SUMMARY_MAX_TOKENS)})
 
 # ---------------- START ----------------
+# gunicorn imports this module without running __main__, so set up the schema here
+init_db()
+
 if __name__ == "__main__":
-    init_db()
     app.run(host="0.0.0.0", port=PORT)
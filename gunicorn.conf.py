@@ -0,0 +1,8 @@
+import os
+
+# Picked up automatically by `gunicorn app:app`; tune per deploy through the environment.
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+# each gevent worker holds this many requests in flight (mostly waiting on Gemini/OpenAI)
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 200))
@@ -87,23 +87,64 @@ async function addWater() {
   waterCount.innerText = d.count;
 }
 
+/* ---------------- STREAMING ---------------- */
+// Reads a text/event-stream reply and shows the text as it arrives.
+// Returns the full text, or null after showing an error.
+async function streamInto(el, url, options = {}) {
+  const r = await fetch(url, {
+    ...options,
+    headers: { ...(options.headers || {}), "Accept": "text/event-stream" }
+  });
+  const type = r.headers.get("Content-Type") || "";
+  if (!r.ok || !type.includes("text/event-stream")) {
+    // error pages (and any plain JSON answer) have no events to read
+    const d = type.includes("application/json") ? await r.json() : {};
+    const text = r.ok ? (d.reply || d.summary || "") : "";
+    el.innerText = text || d.error || "Server error. Please try again.";
+    return r.ok ? text : null;
+  }
+  const reader = r.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  let text = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+
+    let end;
+    while ((end = buf.indexOf("\n\n")) >= 0) {
+      const event = buf.slice(0, end);
+      buf = buf.slice(end + 2);
+      if (event.startsWith("event: error")) {
+        // the server hit an error mid-reply; keep what arrived and say it's cut short
+        const err = JSON.parse(event.slice(event.indexOf("data: ") + 6)).error;
+        el.innerText = text ? `${text}\n\n(${err})` : err;
+        return null;
+      }
+      if (event.startsWith("data: ")) {
+        text += JSON.parse(event.slice(6)).delta;
+        el.innerText = text;
+      }
+    }
+  }
+  return text;
+}
+
 /* ---------------- CHAT ---------------- */
 async function askAI() {
   chatOutput.innerText = "Thinking...";
-  const r = await fetch("/api/chat", {
+  await streamInto(chatOutput, "/api/chat", {
     method: "POST",
     headers: {"Content-Type": "application/json"},
     body: JSON.stringify({ message: chatInput.value })
   });
-  const d = await r.json();
-  chatOutput.innerText = d.reply;
 }
 
 async function dailySummary() {
   chatOutput.innerText = "Generating...";
-  const r = await fetch("/api/daily_summary");
-  const d = await r.json();
-  chatOutput.innerText = d.summary;
+  await streamInto(chatOutput, "/api/daily_summary");
 }
 
 /* ---------------- IMAGE ---------------- */
@@ -113,8 +154,29 @@ async function uploadImage() {
 
   imageOutput.innerText = "Analyzing...";
   const r = await fetch("/api/upload_image", { method: "POST", body: f });
-  const d = await r.json();
-  imageOutput.innerText = d.medical_assistance;
+  const isJson = (r.headers.get("Content-Type") || "").includes("application/json");
+  const { job, error } = isJson ? await r.json() : {};
+  if (!r.ok || !job) {
+    imageOutput.innerText = error || "Image upload failed.";
+    return;
+  }
+
+  // analysis runs in the background; poll until it's ready (the server gives
+  // up on a job after 3 minutes, so stop a little after that)
+  for (let i = 0; i < 200; i++) {
+    await new Promise(res => setTimeout(res, 1000));
+    const jr = await fetch(`/api/job/${job}`);
+    if (!jr.ok) {
+      imageOutput.innerText = "Image analysis failed. Please try again.";
+      return;
+    }
+    const d = await jr.json();
+    if (d.done) {
+      imageOutput.innerText = d.result;
+      return;
+    }
+  }
+  imageOutput.innerText = "Image analysis timed out. Please try again.";
 }
 
 /* ---------------- INIT ---------------- */
@@ -134,14 +196,12 @@ async function summarize() {
   summaryOutput.innerText = "Summarizing...";
 
   try {
-    const r = await fetch("/api/summarize", {
+    const summary = await streamInto(summaryOutput, "/api/summarize", {
       method: "POST",
       headers: {"Content-Type": "application/json"},
       body: JSON.stringify({ text })
     });
-
-    const d = await r.json();
-    summaryOutput.innerText = d.summary || "No summary returned.";
+    if (summary === "") summaryOutput.innerText = "No summary returned.";
   } catch {
     summaryOutput.innerText = "Summarize failed (server error).";
   }